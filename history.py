@@ -0,0 +1,156 @@
+"""
+A SQLite store of milestone status over time. Every sync appends one
+row per milestone per snapshot, so questions like "when did milestone 19
+move to Finished" don't require rereading the raw backups.
+"""
+import bisect
+from datetime import datetime, timedelta
+import glob
+import json
+import logging
+import os
+import sqlite3
+
+from utils import AWARDEE_TO_TEAM, get_status_from_gh
+
+
+TEAM_TO_AWARDEE = {team: awardee for awardee, team in AWARDEE_TO_TEAM.items()}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS milestone_history (
+    snapshot TEXT NOT NULL,
+    milestone_id TEXT NOT NULL,
+    issue_number INTEGER,
+    state TEXT,
+    status TEXT,
+    awardee TEXT,
+    labels TEXT,
+    due_date TEXT,
+    PRIMARY KEY (snapshot, milestone_id)
+);
+CREATE INDEX IF NOT EXISTS milestone_history_by_id
+    ON milestone_history (milestone_id, snapshot);
+CREATE INDEX IF NOT EXISTS milestone_history_by_awardee
+    ON milestone_history (awardee, snapshot);
+"""
+
+
+def open_history(filepath):
+    """
+    Open (and create if needed) the history store at filepath.
+    """
+    dirname = os.path.dirname(filepath)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+    db = sqlite3.connect(filepath)
+    db.executescript(SCHEMA)
+    return db
+
+
+def extract_due_date(body):
+    """
+    Return the due date from a milestone issue body, or None.
+    """
+    for line in (body or "").split("\n"):
+        if line.startswith("due date:"):
+            return line[len("due date:"):].strip()
+    return None
+
+
+def append_history(db, snapshot, milestones):
+    """
+    Record the state of each milestone in milestones (as returned by
+    extract_milestone_info) under the ISO timestamp snapshot.
+    """
+    rows = []
+    for milestone_id, info in milestones.items():
+        awardee = None
+        for label in info["teams"]:
+            awardee = TEAM_TO_AWARDEE.get(label, awardee)
+
+        rows.append((snapshot,
+                     milestone_id,
+                     info["issue_number"],
+                     info["state"],
+                     get_status_from_gh(info),
+                     awardee,
+                     ",".join(sorted(info["teams"])),
+                     extract_due_date(info["body"])))
+
+    with db:
+        db.executemany(
+            "INSERT OR REPLACE INTO milestone_history VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            rows)
+
+
+def import_backups(db, backup_dir="backups"):
+    """
+    Load every backups/backup_<timestamp>.json that is not yet in the
+    store. Snapshots already imported are skipped by filename, without
+    reading the file.
+    """
+    known = {row[0] for row in
+             db.execute("SELECT DISTINCT snapshot FROM milestone_history")}
+
+    for filepath in sorted(glob.glob(os.path.join(backup_dir, "backup_*.json"))):
+        snapshot = os.path.basename(filepath)[len("backup_"):-len(".json")]
+        if snapshot in known:
+            continue
+
+        logging.info(f"importing {filepath}")
+        with open(filepath, "rt") as f:
+            data = json.load(f)
+        append_history(db, snapshot, data["milestones"])
+
+
+def load_as_of(db, as_of):
+    """
+    Return a dictionary mapping milestone ID to its record in the
+    latest snapshot taken on or before the ISO date as_of.
+    """
+    next_day = datetime.strptime(as_of, "%Y-%m-%d").date() + timedelta(days=1)
+    row = db.execute(
+        "SELECT MAX(snapshot) FROM milestone_history WHERE snapshot < ?",
+        (next_day.isoformat(),)).fetchone()
+    if row[0] is None:
+        return {}
+
+    milestones = {}
+    for milestone_id, issue_number, state, labels, awardee, due_date in db.execute(
+            "SELECT milestone_id, issue_number, state, labels, awardee, due_date "
+            "FROM milestone_history WHERE snapshot = ?", (row[0],)):
+        milestones[milestone_id] = {
+            "id": milestone_id,
+            "issue_number": issue_number,
+            "state": state,
+            "teams": labels.split(",") if labels else [],
+            "awardee": awardee,
+            "due_date": due_date,
+        }
+    return milestones
+
+
+def weekly_trend(db):
+    """
+    Yield (week, awardee, status, count) for every week covered by the
+    store, using the last snapshot taken in or before each week.
+    """
+    snapshots = [row[0] for row in db.execute(
+        "SELECT DISTINCT snapshot FROM milestone_history ORDER BY snapshot")]
+    if not snapshots:
+        return
+
+    first = datetime.strptime(snapshots[0][:10], "%Y-%m-%d").date()
+    last = datetime.strptime(snapshots[-1][:10], "%Y-%m-%d").date()
+    week = first - timedelta(days=first.weekday())
+
+    while week <= last:
+        week_end = (week + timedelta(days=7)).isoformat()
+        n = bisect.bisect_left(snapshots, week_end)
+        if n:
+            for awardee, status, count in db.execute(
+                    "SELECT awardee, status, COUNT(*) FROM milestone_history "
+                    "WHERE snapshot = ? GROUP BY awardee, status "
+                    "ORDER BY awardee, status", (snapshots[n - 1],)):
+                yield week.isoformat(), awardee, status, count
+        week += timedelta(days=7)
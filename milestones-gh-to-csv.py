@@ -8,14 +8,18 @@ import sys
 import time
 import math
 import csv
+import hashlib
+import html
 
-from github import Github
 from github.GithubException import UnknownObjectException
 import pandas as pd
 
 
 from utils import AWARDEE_TO_TEAM, LABELS
-from utils import fetch_issues_by_repo, extract_milestone_info
+from utils import fetch_issues_by_repo, extract_milestone_info, get_status_from_gh
+from utils import GithubPool, get_tokens
+from history import open_history, append_history, import_backups
+from history import load_as_of, weekly_trend
 
 
 # Set up logging
@@ -41,15 +45,6 @@ def set_log_level_from_verbose(args):
         consoleHandler.setLevel("ERROR")
 
 
-def get_status_from_gh(record):
-    status = "Not Started"
-    if 'started' in record["teams"]:
-        status = 'In Progress'
-    if record["state"] == "closed":
-        status = "Finished"
-    return status
-
-
 def isnull(field):
     isnan = False
     try:
@@ -67,6 +62,14 @@ def null_to_default(field, default=''):
         return field
 
 
+def iso_date(value):
+    try:
+        datetime.strptime(value, "%Y-%m-%d")
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"{value!r} is not a YYYY-MM-DD date")
+    return value
+
+
 def get_awardee_from_csv(info):
     # labels!
     awardee = info['Awardee']
@@ -92,6 +95,24 @@ def load_gh_and_csv(g, args):
     ## STEP 2:
     ## read local data from spreadsheets,
 
+    milestone_d = load_csv(args)
+
+    ## check versus each other?
+    github_ids = set(milestone_gh)
+    csv_ids = set(milestone_d)
+
+    if github_ids - csv_ids:
+        print('in github, not in CSV:', github_ids - csv_ids)
+        assert 0
+
+    if csv_ids - github_ids:
+        print('in csv, not in github:', csv_ids - github_ids)
+        assert 0
+
+    return milestone_gh, milestone_d
+
+
+def load_csv(args):
     print('loading from CSV')
     milestone_data = pd.read_csv(args.milestones_csv)
 
@@ -107,35 +128,59 @@ def load_gh_and_csv(g, args):
 
         milestone_d[milestone_id] = info
 
-    ## check versus each other?
-    github_ids = set(milestone_gh)
-    csv_ids = set(milestone_d)
+    return milestone_d
 
-    if github_ids - csv_ids:
-        print('in github, not in CSV:', github_ids - csv_ids)
-        assert 0
 
-    if csv_ids - github_ids:
-        print('in csv, not in github:', csv_ids - github_ids)
-        assert 0
+def load_history_and_csv(db, args):
+    """
+    Load milestone status as of args.as_of from the history store,
+    keeping only the milestones that are also in the CSV.
+    """
+    milestone_hist = load_as_of(db, args.as_of)
+    if not milestone_hist:
+        print('no history recorded on or before', args.as_of)
+        sys.exit(1)
 
-    return milestone_gh, milestone_d
+    milestone_d = load_csv(args)
 
+    missing = set(milestone_hist) - set(milestone_d)
+    if missing:
+        print('WARNING: in history, not in CSV:', missing)
+        for milestone_id in missing:
+            del milestone_hist[milestone_id]
+
+    return milestone_hist, milestone_d
 
-def extract_report(milestone_gh, milestone_d, outfp, select_awardee=None):
-    w = csv.DictWriter(outfp, fieldnames=['milestone_id',
-                                          'status',
-                                          'due_date',
-                                          'task',
-                                          'awardee',
-                                          'kc',
-                                          'github_issue_url'])
-    w.writeheader()
 
+def write_trend(db, outfp):
+    w = csv.writer(outfp)
+    w.writerow(['week', 'awardee', 'status', 'count'])
+    for row in weekly_trend(db):
+        w.writerow(row)
+
+
+REPORT_FIELDS = ['milestone_id',
+                 'status',
+                 'due_date',
+                 'task',
+                 'awardee',
+                 'kc',
+                 'github_issue_url']
+
+
+def build_report_rows(milestone_gh, milestone_d, select_awardee=None):
+    rows = []
     for milestone_id in milestone_gh:
-        status = get_status_from_gh(milestone_gh[milestone_id])
-        awardee = get_awardee_from_csv(milestone_d[milestone_id])
-        issue_number = milestone_gh[milestone_id]["issue_number"]
+        gh_record = milestone_gh[milestone_id]
+        status = get_status_from_gh(gh_record)
+        issue_number = gh_record["issue_number"]
+
+        # records from the history store carry their own awardee and
+        # due date as of that snapshot.
+        if "awardee" in gh_record:
+            awardee = gh_record["awardee"]
+        else:
+            awardee = get_awardee_from_csv(milestone_d[milestone_id])
 
         github_url = f"https://github.com/dcppc/dcppc-milestones/issues/{issue_number}"
 
@@ -145,18 +190,156 @@ def extract_report(milestone_gh, milestone_d, outfp, select_awardee=None):
             d = dict(milestone_id=milestone_id,
                      status=status, awardee=awardee,
                      task=record['Task'],
-                     due_date=null_to_default(record['Revised Due Date']),
+                     due_date=null_to_default(gh_record.get('due_date', record['Revised Due Date'])),
                      kc=record['Key Capability'],
                      github_issue_url=github_url)
 
-            w.writerow(d)
+            rows.append(d)
+    return rows
+
+
+def write_csv_report(rows, outfp):
+    w = csv.DictWriter(outfp, fieldnames=REPORT_FIELDS)
+    w.writeheader()
+    for d in rows:
+        w.writerow(d)
+
+
+STATUSES = ['Not Started', 'In Progress', 'Finished']
+
+
+def status_counts(rows):
+    """
+    Return a list of (status, count) for the report rows, followed by
+    the total.
+    """
+    counts = [(status, sum(1 for d in rows if d['status'] == status))
+              for status in STATUSES]
+    counts.append(('Total', len(rows)))
+    return counts
+
+
+def write_markdown_report(rows, outfp):
+    outfp.write('## Status\n\n')
+    outfp.write('| status | count |\n|---|---|\n')
+    for status, count in status_counts(rows):
+        outfp.write('| {} | {} |\n'.format(status, count))
+
+    outfp.write('\n## Milestones\n\n')
+    outfp.write('| ' + ' | '.join(REPORT_FIELDS) + ' |\n')
+    outfp.write('|' + '---|' * len(REPORT_FIELDS) + '\n')
+    for d in rows:
+        cells = [str(null_to_default(d[field])).replace('|', '\\|')
+                 for field in REPORT_FIELDS]
+        cells[-1] = '[#{}]({})'.format(d['github_issue_url'].split('/')[-1],
+                                       d['github_issue_url'])
+        outfp.write('| ' + ' | '.join(cells) + ' |\n')
+
+
+def write_html_report(rows, outfp):
+    outfp.write('<h2>Status</h2>\n<table>\n<tr><th>status</th><th>count</th></tr>\n')
+    for status, count in status_counts(rows):
+        outfp.write('<tr><td>{}</td><td>{}</td></tr>\n'.format(html.escape(status), count))
+    outfp.write('</table>\n')
+
+    outfp.write('<h2>Milestones</h2>\n<table>\n<tr>')
+    for field in REPORT_FIELDS:
+        outfp.write('<th>{}</th>'.format(html.escape(field)))
+    outfp.write('</tr>\n')
+    for d in rows:
+        outfp.write('<tr>')
+        for field in REPORT_FIELDS[:-1]:
+            outfp.write('<td>{}</td>'.format(html.escape(str(null_to_default(d[field])))))
+        url = html.escape(d['github_issue_url'])
+        outfp.write('<td><a href="{}">{}</a></td>'.format(url, url))
+        outfp.write('</tr>\n')
+    outfp.write('</table>\n')
+
+
+def extract_report(milestone_gh, milestone_d, outfp, select_awardee=None):
+    rows = build_report_rows(milestone_gh, milestone_d, select_awardee)
+    write_csv_report(rows, outfp)
+
+
+# bump this whenever a report writer changes its output, so existing
+# reports are regenerated once.
+REPORT_FORMAT_VERSION = 1
+
+
+def rows_digest(rows, suffix):
+    """
+    Return a digest of the report rows and output format, used to skip
+    rewriting reports whose contents have not changed.
+    """
+    data = json.dumps(dict(format=REPORT_FORMAT_VERSION, suffix=suffix, rows=rows),
+                      sort_keys=True, default=str)
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+def write_atomically(filepath, write_fn):
+    """
+    Call write_fn on a temporary file next to filepath, then move it
+    into place, so readers never see a partially written file.
+    """
+    tmp_path = filepath + '.tmp'
+    try:
+        with open(tmp_path, 'wt') as outfp:
+            write_fn(outfp)
+        os.replace(tmp_path, filepath)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+
+def write_reports(milestone_gh, milestone_d, args):
+    """
+    Write a report for each awardee, in CSV and optionally Markdown and
+    HTML. A report is only rewritten if its rows differ from the last
+    time it was written, as recorded in the args.digests file.
+    """
+    writers = [('.csv', write_csv_report)]
+    if args.markdown:
+        writers.append(('.md', write_markdown_report))
+    if args.html:
+        writers.append(('.html', write_html_report))
+
+    digests = {}
+    if os.path.exists(args.digests):
+        with open(args.digests, 'rt') as f:
+            digests = json.load(f)
+    changed = False
+
+    for select_awardee in AWARDEE_TO_TEAM:
+        print('building report for {}...'.format(select_awardee))
+        rows = build_report_rows(milestone_gh, milestone_d, select_awardee)
+
+        for suffix, write_fn in writers:
+            digest = rows_digest(rows, suffix)
+            report_name = args.output_prefix + select_awardee + suffix
+            if digests.get(report_name) == digest and os.path.exists(report_name):
+                print('... {} unchanged'.format(report_name))
+                continue
+
+            print('... in {}'.format(report_name))
+            write_atomically(report_name,
+                             lambda outfp: write_fn(rows, outfp))
+            digests[report_name] = digest
+            changed = True
+
+    if changed:
+        dirname = os.path.dirname(args.digests)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        write_atomically(args.digests,
+                         lambda outfp: json.dump(digests, outfp, indent=2, sort_keys=True))
 
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('-o', '--output-prefix',
                         default='report-team-', help='output filename prefix')
-    parser.add_argument('milestones_csv', default='../dcppc-project-management/phase-1/milestones.csv')
+    parser.add_argument('milestones_csv', nargs='?', default='../dcppc-project-management/phase-1/milestones.csv')
     parser.add_argument(
         "-v",
         "--verbose",
@@ -169,7 +352,48 @@ def main():
         help="milestones repo name",
         default="dcppc/dcppc-milestones",
     )
-    parser.add_argument("--token", help="GitHub auth token", type=str, default="")
+    parser.add_argument(
+        "--token",
+        help="GitHub auth token; repeat or comma-separate to spread requests over several tokens",
+        action="append",
+        default=[],
+    )
+    parser.add_argument(
+        "--history",
+        help="status history store that each run appends to",
+        default=os.path.join("backups", "history.db"),
+    )
+    parser.add_argument(
+        "--import-backups",
+        help="first load any backups/backup_*.json not yet in the history store",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--as-of",
+        type=iso_date,
+        help="report status as of this date (YYYY-MM-DD) from the history store, "
+             "into asof-<DATE>-<output prefix> files",
+    )
+    parser.add_argument(
+        "--digests",
+        help="where to record what each report last contained",
+        default=os.path.join("backups", "report-digests.json"),
+    )
+    parser.add_argument(
+        "--markdown",
+        help="also write a Markdown status summary and table for each team",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--html",
+        help="also write an HTML status summary and table for each team",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--trend",
+        help="print weekly status counts per team from the history store",
+        action="store_true",
+    )
 
     args = parser.parse_args()
     if not vars(args):
@@ -178,28 +402,36 @@ def main():
 
     set_log_level_from_verbose(args)
 
-    if args.token:
-        g = Github(args.token)
-    else:
-        # Try to read the GITHUB_TOKEN env var
-        try:
-            g = Github(os.environ["GITHUB_TOKEN"])
-        except KeyError:
-            logging.error(
-                "Please provide a GitHub auth token using --token "
-                "or the GITHUB_TOKEN env var"
-            )
-            sys.exit(1)
+    db = open_history(args.history)
+    if args.import_backups:
+        import_backups(db)
+
+    if args.trend:
+        write_trend(db, sys.stdout)
+        return
+
+    if args.as_of:
+        # keep historical reports away from the live ones.
+        dirname, basename = os.path.split(args.output_prefix)
+        args.output_prefix = os.path.join(dirname, f'asof-{args.as_of}-' + basename)
+
+        milestone_gh, milestone_d = load_history_and_csv(db, args)
+        write_reports(milestone_gh, milestone_d, args)
+        return
+
+    tokens = get_tokens(args)
+    if not tokens:
+        logging.error(
+            "Please provide a GitHub auth token using --token "
+            "or the GITHUB_TOKEN env var"
+        )
+        sys.exit(1)
+    g = GithubPool(tokens)
 
     milestone_gh, milestone_d = load_gh_and_csv(g, args)
+    append_history(db, datetime.utcnow().isoformat(), milestone_gh)
 
-    for select_awardee in AWARDEE_TO_TEAM:
-        print('building report for {}...'.format(select_awardee))
-        report_name = args.output_prefix + select_awardee + '.csv'
-        print('... in {}'.format(report_name))
-        with open(report_name, 'wt') as outfp:
-            extract_report(milestone_gh, milestone_d,
-                           outfp, select_awardee=select_awardee)
+    write_reports(milestone_gh, milestone_d, args)
 
 
 if __name__ == "__main__":
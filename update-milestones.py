@@ -8,12 +8,14 @@ import sys
 import time
 import math
 
-from github import Github
 from github.GithubException import UnknownObjectException
 import pandas as pd
 
 from utils import AWARDEE_TO_TEAM, LABELS, KC_STRING_TO_KC_LABEL
 from utils import fetch_issues_by_repo, extract_milestone_info
+from utils import GithubPool, get_tokens
+from history import open_history, append_history
+from utils import row_fingerprint, load_journal, append_journal, pending_writes
 
 
 # Set up logging
@@ -26,20 +28,20 @@ consoleHandler.setFormatter(logFormatter)
 logger.addHandler(consoleHandler)
 
 
-def create_labels(repo, labels):
+def create_labels(g, repo, labels):
     """
     For each label in LABELS, make sure that label exists in 
     repo's list of labels. This action happens at the 
     repository scope.
     """
-    current_labels = {label.name: label for label in repo.get_labels()}
+    current_labels = {label.name: label
+                      for label in g.call(lambda r: list(r.get_labels()), repo)}
     for label, color in labels.items():
         if label not in current_labels:
-            repo.create_label(label, color)
-        else:
+            g.call(lambda r: r.create_label(label, color), repo)
+        elif current_labels[label].color != color:
             # Update color
-            this_label = repo.get_label(label)
-            this_label.edit(label, color)
+            g.call(lambda l: l.edit(label, color), current_labels[label])
 
 
 def create_issue_body_milestone(info):
@@ -74,20 +76,23 @@ due date: {}
 """.format(title, description, record_number, due_date)
 
 
-def create_issue(repo, title, body, *, labels=None, change_github=False):
+def create_issue(g, repo, title, body, *, labels=None, change_github=False):
     """
-    Create an issue in repo with the given title and description.
+    Create an issue in repo with the given title and description,
+    using whichever token in the GithubPool g has budget left.
     """
     if labels is None:
         labels = []
+    labels = list(labels)
     if change_github:
-        return repo.create_issue(title, body, labels=labels)
+        return g.call(lambda r: r.create_issue(title, body, labels=labels), repo)
 
 
-def update_issue(repo, issue, *, body=None, labels=None, title=None, change_github=False):
+def update_issue(g, repo, issue, *, body=None, labels=None, title=None, change_github=False):
     """
     Update the body/title/labels of the specified milestone issue
-    in the specified repository.
+    in the specified repository, using whichever token in the
+    GithubPool g has budget left.
     """
     if labels is None:
         labels = []
@@ -95,8 +100,12 @@ def update_issue(repo, issue, *, body=None, labels=None, title=None, change_gith
 
     if title is None:
         title = issue.title
-    if change_github:
+    def edit(issue):
         issue.edit(body=body, title=title, labels=labels)
+        return issue
+
+    if change_github:
+        issue = g.call(edit, issue)
 
     return issue
 
@@ -156,7 +165,12 @@ def add_common_args(parser):
         action="store_true",
         default=False,
     )
-    parser.add_argument("--token", help="GitHub auth token", type=str, default="")
+    parser.add_argument(
+        "--token",
+        help="GitHub auth token; repeat or comma-separate to spread requests over several tokens",
+        action="append",
+        default=[],
+    )
 
     parser.add_argument(
         "-b",
@@ -164,15 +178,20 @@ def add_common_args(parser):
         help="Current GitHub issue data will be saved to this file",
         type=str,
     )
+    parser.add_argument(
+        "--history",
+        help="status history store that each sync appends to, after its writes",
+        default=os.path.join("backups", "history.db"),
+    )
 
 
-def bulk_create_issues(repo, target):
+def bulk_create_issues(g, repo, target):
     """
     Create multiple placeholder issues in the repository
     """
-    issue = create_issue(repo, "PLACEHOLDER", "")
+    issue = create_issue(g, repo, "PLACEHOLDER", "", change_github=True)
     while issue.number < target:
-        issue = create_issue(repo, "PLACEHOLDER", "")
+        issue = create_issue(g, repo, "PLACEHOLDER", "", change_github=True)
         logging.debug("Bulk-created issue {issue.number}")
     return issue
 
@@ -215,7 +234,7 @@ def restore(g, args):
 
             # Issue doesn't exist yet, we need to create empty ones to get the
             # right issue number
-            issue = bulk_create_issues(milestone_repo, int(info["issue_number"]))
+            issue = bulk_create_issues(g, milestone_repo, int(info["issue_number"]))
 
         # issue already exits, let's update it
         labels = {label.name for label in issue.labels}
@@ -229,6 +248,7 @@ def restore(g, args):
                   labels == set(info["teams"]),
                   issue.title == info["title"])
             update_issue(
+                g,
                 milestone_repo,
                 issue,
                 body=info["body"],
@@ -240,7 +260,7 @@ def restore(g, args):
             logging.debug(f"Already up to date {info['issue_number']}")
 
     # make sure the repository has all the labels
-    create_labels(deliverables_repo, LABELS)
+    create_labels(g, deliverables_repo, LABELS)
 
     # load and sort deliverables issues by issue number
     items = sorted(
@@ -257,7 +277,7 @@ def restore(g, args):
 
             # Issue doesn't exist yet, we need to create empty ones to get the
             # right issue number
-            issue = bulk_create_issues(deliverables_repo, int(info["issue_number"]))
+            issue = bulk_create_issues(g, deliverables_repo, int(info["issue_number"]))
 
         # issue already exits, let's update it
         labels = {label.name for label in issue.labels}
@@ -268,6 +288,7 @@ def restore(g, args):
         ):
             logging.info(f"Need to update {info['issue_number']}")
             update_issue(
+                g,
                 deliverables_repo,
                 issue,
                 body=info["body"],
@@ -296,31 +317,96 @@ def backup_issues(g, milestone_repo, backup_file):
     return milestone_issues
 
 
+def resume_journal(g, milestone_repo, pending, fingerprints, args, journal):
+    """
+    Finish the edits left over from an interrupted run, without listing
+    the whole repo. Entries whose CSV row has changed since they were
+    planned are marked superseded instead of being resent. The remaining
+    issues are fetched one by one and backed up to args.backup, and each
+    is only edited if it does not already match what was planned.
+    """
+    resumable = []
+    for entry in pending:
+        if fingerprints.get(entry["milestone_id"]) != entry["fingerprint"]:
+            logging.info(f"Dropping stale write for {entry['milestone_id']}")
+            append_journal(args.journal, journal,
+                           dict(entry, status="done", superseded=True))
+        else:
+            resumable.append(entry)
+
+    milestone_issues = {}
+    for entry in resumable:
+        issue = g.call(lambda r: r.get_issue(entry["issue_number"]), milestone_repo)
+        milestone_issues[entry["milestone_id"]] = extract_milestone_info(issue)
+
+    # back up the issues about to be edited before touching them.
+    save_issues(milestone_issues, args.backup)
+
+    for entry in resumable:
+        issue = milestone_issues[entry["milestone_id"]]["issue_obj"]
+        current_labels = {label.name for label in issue.labels}
+        labels = set(entry["labels"])
+
+        if issue.title != entry["title"] or issue.body != entry["body"] \
+              or not labels.issubset(current_labels):
+            logging.info(f"Resuming update of {entry['milestone_id']}")
+            labels.update(current_labels)
+            update_issue(
+                g, milestone_repo, issue, title=entry["title"], body=entry["body"],
+                labels=labels, change_github=True
+            )
+        else:
+            logging.debug(f"Already applied {entry['milestone_id']}")
+
+        append_journal(args.journal, journal, dict(entry, status="done"))
+
+
 def update(g, args):
     """
     Back up all the Github issues in a repo, then update each issue
     in the repo using the milestones CSV file.
+
+    Every write is recorded in the journal at args.journal before it
+    is sent and marked done afterwards. If a previous run was
+    interrupted with only edits left unfinished, just those issues are
+    fetched, backed up, verified and edited, and the run stops there
+    without listing the repo; run again for a full comparison. Writes
+    already marked done are not looked at again. Unfinished creations
+    carry no issue number, so they fall back to a full run, which
+    compares every CSV row against the listed issues.
     """
+    milestone_repo = g.get_repo(args.milestones)
+    milestone_data = pd.read_csv(args.milestones_csv)
+
+    journal = {}
+    if args.change_github:
+        journal = load_journal(args.journal)
+        pending = pending_writes(journal)
+
+        if pending and all(entry["issue_number"] for entry in pending):
+            fingerprints = {str(info["Record Number"]): row_fingerprint(info)
+                            for i, info in milestone_data.iterrows()}
+            logging.info(f"Resuming {len(pending)} unfinished writes from {args.journal}")
+            resume_journal(g, milestone_repo, pending, fingerprints, args, journal)
+            return
 
     # STEP 1: 
     # read data from github issues, back it up
 
-    milestone_repo = g.get_repo(args.milestones)
     milestone_issues = backup_issues(
         g, milestone_repo, args.backup
     )
 
     # STEP 2:
-    # read local data from spreadsheets,
+    # compare local data from spreadsheets,
     # check if updates are needed
     # and update github issues
 
-    milestone_data = pd.read_csv(args.milestones_csv)
-
     # make sure the repository has all the labels
-    create_labels(milestone_repo, LABELS)
+    create_labels(g, milestone_repo, LABELS)
 
-    # list of issues to update
+    # lists of issues to create and to update
+    create_list = []
     update_list = []
 
     seen = set ()
@@ -332,6 +418,9 @@ def update(g, args):
             continue
         seen.add(milestone_id)
 
+        fingerprint = row_fingerprint(info)
+        entry = journal.get(milestone_id)
+
         # Get the awardee for this milestone
         awardee = info['Awardee']
 
@@ -373,13 +462,7 @@ def update(g, args):
                 assert 0, "use -f if we are expected to be creating issues"
 
             title = info["Task"]
-            issue = create_issue(milestone_repo, title, body, labels=labels, change_github=args.change_github)
-
-            if args.change_github:
-                info = extract_milestone_info(issue)
-                milestone_issues[milestone_id] = info
-            else:
-                logging.info("not actually changing github -- use --change-github to do that.")
+            create_list.append((milestone_id, fingerprint, title, body, labels))
         else:
             title = info["Task"]
             issue = milestone_issues[milestone_id]
@@ -399,17 +482,50 @@ def update(g, args):
                 logging.info(f"Need to update {milestone_id}")
                 logging.debug(f"old body: {issue['body']}")
                 logging.debug(f"new body: {body}")
-                update_list.append((issue["issue_obj"], title, body, labels))
-
-    if update_list:
-        if len(update_list) > 10 and not args.force:
-            logging.error(f"Too many issues to update without --force {len(update_list)}; quitting.")
-            sys.exit(-1)
-
-        for issue_obj, title, body, labels in update_list:
-            issue = update_issue(
-               milestone_repo, issue_obj, title=title, body=body, labels=labels, change_github=args.change_github
+                update_list.append((milestone_id, fingerprint, issue["issue_obj"], title, body, labels))
+            elif entry and entry["status"] == "planned":
+                # left over from an interrupted run, and already applied.
+                append_journal(args.journal, journal,
+                               dict(entry, status="done", issue_number=issue["issue_number"]))
+
+    if len(update_list) > 10 and not args.force:
+        logging.error(f"Too many issues to update without --force {len(update_list)}; quitting.")
+        sys.exit(-1)
+
+    db = open_history(args.history)
+
+    if not args.change_github:
+        if create_list or update_list:
+            logging.info("not actually changing github -- use --change-github to do that.")
+        append_history(db, args.snapshot, milestone_issues)
+        return
+
+    # record every planned write before sending any of them
+    for milestone_id, fingerprint, title, body, labels in create_list:
+        append_journal(args.journal, journal, dict(
+            milestone_id=milestone_id, fingerprint=fingerprint, issue_number=None,
+            action="create", status="planned", title=title, body=body, labels=sorted(labels)))
+    for milestone_id, fingerprint, issue_obj, title, body, labels in update_list:
+        append_journal(args.journal, journal, dict(
+            milestone_id=milestone_id, fingerprint=fingerprint, issue_number=issue_obj.number,
+            action="update", status="planned", title=title, body=body, labels=sorted(labels)))
+
+    for milestone_id, fingerprint, title, body, labels in create_list:
+        issue = create_issue(g, milestone_repo, title, body, labels=labels, change_github=True)
+        milestone_issues[milestone_id] = extract_milestone_info(issue)
+        append_journal(args.journal, journal, dict(
+            journal[milestone_id], status="done", issue_number=issue.number))
+
+    for milestone_id, fingerprint, issue_obj, title, body, labels in update_list:
+        issue = update_issue(
+           g, milestone_repo, issue_obj, title=title, body=body, labels=labels, change_github=True
         )
+        milestone_issues[milestone_id] = extract_milestone_info(issue)
+        append_journal(args.journal, journal, dict(
+            journal[milestone_id], status="done"))
+
+    # record the state after this sync's writes, not before them.
+    append_history(db, args.snapshot, milestone_issues)
 
 
 def main():
@@ -424,6 +540,12 @@ def main():
         "update", help="Update files based on local spreadsheets"
     )
     parser_update.add_argument('milestones_csv')
+    parser_update.add_argument(
+        "--journal",
+        help="journal of planned and applied writes, used to resume failed runs",
+        type=str,
+        default="update-journal.jsonl",
+    )
     add_common_args(parser_update)
     parser_update.set_defaults(func=update)
 
@@ -448,24 +570,21 @@ def main():
     logging.warning(f"warning")
     logging.debug(f"debug")
 
-    if args.token:
-        g = Github(args.token)
-    else:
-        # Try to read the GITHUB_TOKEN env var
-        try:
-            g = Github(os.environ["GITHUB_TOKEN"])
-        except KeyError:
-            logging.error(
-                "Please provide a GitHub auth token using --token "
-                "or the GITHUB_TOKEN env var; "
-                "You will need this to make changes."
-            )
-
-            g = Github()
+    tokens = get_tokens(args)
+    if not tokens:
+        logging.error(
+            "Please provide a GitHub auth token using --token "
+            "or the GITHUB_TOKEN env var; "
+            "You will need this to make changes."
+        )
+    g = GithubPool(tokens)
 
+    # the backup and the history store share a snapshot timestamp, so
+    # importing this backup later does not duplicate the snapshot.
+    args.snapshot = datetime.utcnow().isoformat()
     if args.backup is None:
         os.makedirs("backups", exist_ok=True)
-        now = datetime.utcnow().isoformat()
+        now = args.snapshot
         args.backup = os.path.join("backups", f"backup_{now}.json")
 
     args.func(g, args)
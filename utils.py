@@ -1,3 +1,13 @@
+import hashlib
+import json
+import logging
+import os
+import time
+
+from github import Github
+from github.GithubException import GithubException, RateLimitExceededException
+
+
 AWARDEE_TO_TEAM = {
     "White": "Team-Phosphorus",
     "Brown": "Team-Copper",
@@ -27,11 +37,150 @@ LABELS = {
 }
 
 
+# seconds to rest a token after GitHub's secondary rate limit, when
+# the response has no Retry-After header.
+ABUSE_BACKOFF = 60
+
+
+def get_tokens(args):
+    """
+    Return the list of GitHub auth tokens given with --token, or else
+    in the comma-separated GITHUB_TOKEN env var.
+    """
+    tokens = args.token or [os.environ.get("GITHUB_TOKEN", "")]
+    return [token.strip()
+            for value in tokens for token in value.split(",")
+            if token.strip()]
+
+
+class GithubPool:
+    """
+    A set of GitHub clients, one per token, that spreads requests across
+    the tokens and fails over to another token when one is exhausted.
+    Each token's remaining budget is tracked separately.
+    """
+    def __init__(self, tokens):
+        if tokens:
+            self.clients = [Github(token) for token in tokens]
+        else:
+            self.clients = [Github()]
+        # client index -> time at which it may be used again
+        self.exhausted = {}
+
+    def get_repo(self, name):
+        return self.clients[0].get_repo(name)
+
+    def remaining(self, index):
+        # PyGithub caches this from the client's last response.
+        return self.clients[index].rate_limiting[0]
+
+    def refresh(self, index):
+        """
+        Re-read the budget of client index from GitHub, once the cached
+        count may be out of date because its reset time has passed.
+        """
+        self.clients[index].get_rate_limit()
+
+    def pick(self):
+        """
+        Return the index of the usable client with the most budget left,
+        sleeping until a reset if every client is exhausted.
+        """
+        while True:
+            now = time.time()
+            available = []
+            for index, client in enumerate(self.clients):
+                if self.exhausted.get(index, now) > now:
+                    continue
+                if index in self.exhausted or \
+                      (self.remaining(index) == 0 and client.rate_limiting_resettime <= now):
+                    # past its reset, so the cached count is stale.
+                    self.exhausted.pop(index, None)
+                    self.refresh(index)
+                if self.remaining(index) == 0:
+                    self.exhausted[index] = max(client.rate_limiting_resettime, now + 1)
+                    continue
+                available.append(index)
+
+            if available:
+                return max(available, key=self.remaining)
+
+            wait = max(min(self.exhausted.values()) - now, 1)
+            logging.warning(f"All {len(self.clients)} tokens exhausted; sleeping {wait:.0f}s")
+            time.sleep(wait)
+
+    def backoff_until(self, index, e):
+        """
+        Return the time at which client index may be used again after
+        the rate-limit error e.
+        """
+        headers = getattr(e, "headers", None) or {}
+        if "retry-after" in headers:
+            return time.time() + int(headers["retry-after"])
+        if is_secondary_rate_limit(e):
+            return time.time() + ABUSE_BACKOFF
+        return self.clients[index].rate_limiting_resettime
+
+    def call(self, fn, obj):
+        """
+        Call fn with the PyGithub object obj rebound to the client with
+        the most budget left, retrying on another client if it hits a
+        rate limit.
+        """
+        # rebuild from the data already fetched; obj.raw_data would
+        # first complete obj through the client that created it.
+        raw_data = obj._rawData
+
+        while True:
+            index = self.pick()
+            client = self.clients[index]
+            rebound = client.create_from_raw_data(type(obj), raw_data)
+            try:
+                return fn(rebound)
+            except RateLimitExceededException as e:
+                self.exhausted[index] = self.backoff_until(index, e)
+            except GithubException as e:
+                if e.status != 403 or not is_secondary_rate_limit(e):
+                    raise
+                self.exhausted[index] = self.backoff_until(index, e)
+            logging.warning(f"token {index} is rate limited; failing over")
+
+
+def is_secondary_rate_limit(e):
+    """
+    Return True if the GithubException e is GitHub's secondary (formerly
+    "abuse") rate limit.
+    """
+    message = e.data.get("message", "") if isinstance(e.data, dict) else ""
+    message = str(message).lower()
+    return "secondary rate limit" in message or "abuse" in message
+
+
 def fetch_issues_by_repo(github_client, repo):
-    for issue in repo.get_issues(state='open'):
-        yield issue
-    for issue in repo.get_issues(state='closed'):
-        yield issue
+    """
+    Yield all open and then all closed issues in repo, fetching each
+    page through whichever token in the GithubPool has budget left.
+    """
+    for state in ("open", "closed"):
+        page = 0
+        while True:
+            issues = github_client.call(
+                lambda r: r.get_issues(state=state).get_page(page), repo
+            )
+            if not issues:
+                break
+            for issue in issues:
+                yield issue
+            page += 1
+
+
+def get_status_from_gh(record):
+    status = "Not Started"
+    if 'started' in record["teams"]:
+        status = 'In Progress'
+    if record["state"] == "closed":
+        status = "Finished"
+    return status
 
 
 def extract_milestone_info(issue):
@@ -56,3 +205,72 @@ def extract_milestone_info(issue):
     }
 
     return info
+
+
+# CSV columns that determine what a milestone issue should look like.
+FINGERPRINT_FIELDS = ("Record Number", "Task", "Description",
+                      "Revised Due Date", "Awardee", "Key Capability")
+
+
+def row_fingerprint(info):
+    """
+    Return a stable hash of the CSV fields that feed a milestone issue,
+    so that a write can be recognized across runs.
+    """
+    h = hashlib.sha1()
+    for field in FINGERPRINT_FIELDS:
+        h.update(str(info.get(field, "")).encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+def load_journal(filepath):
+    """
+    Read the write journal at filepath and return a dictionary mapping
+    each milestone ID to its most recent entry; later entries for a
+    milestone replace earlier ones.
+    """
+    journal = {}
+    if not os.path.exists(filepath):
+        return journal
+
+    with open(filepath, "rt") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # a crash in the middle of an append leaves a partial line.
+                continue
+            journal[entry["milestone_id"]] = entry
+
+    return journal
+
+
+def append_journal(filepath, journal, entry):
+    """
+    Durably append entry to the write journal at filepath, and record
+    it in the in-memory journal. A planned write that is still open for
+    the same milestone is first marked done as superseded, so it is
+    never resent.
+    """
+    previous = journal.get(entry["milestone_id"])
+    if entry["status"] == "planned" and previous and previous["status"] == "planned" \
+          and previous["fingerprint"] != entry["fingerprint"]:
+        append_journal(filepath, journal, dict(previous, status="done", superseded=True))
+
+    with open(filepath, "at") as f:
+        f.write(json.dumps(entry) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    journal[entry["milestone_id"]] = entry
+
+
+def pending_writes(journal):
+    """
+    Return the journal entries that were planned but never marked done.
+    """
+    return [entry for entry in journal.values()
+            if entry["status"] == "planned"]